@@ -5,14 +5,17 @@ A bot that sorts video files by episode number and quality with dump and log cha
 Optimized for Render.com deployment with health checks and webhook support
 """
 import os
-import re
+import sys
 import logging
 import asyncio
 from datetime import datetime
 from typing import List, Dict, Optional
+import aiosqlite
+from cachetools import TTLCache
 from telegram import Update, BotCommand
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from telegram.error import TelegramError
+from telegram.error import TelegramError, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
 import threading
 from http.server import HTTPServer, BaseHTTPRequestHandler
 
@@ -21,6 +24,7 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 LOG_CHANNEL_ID = os.getenv("LOG_CHANNEL_ID", "-1003057761446")
 PORT = int(os.getenv("PORT", 10000))  # Render uses port 10000 by default
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.db")
 
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN environment variable must be set")
@@ -38,6 +42,47 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Recognized video qualities; frozenset gives O(1) membership per parsed file
+_QUALITY_SET = frozenset({144, 240, 360, 480, 720, 1080, 1440, 2160})
+
+def _ascii_digits(s: str) -> bool:
+    """True if s is non-empty and consists only of ASCII 0-9 (tag numbers are
+    ASCII; str.isdigit alone would also accept Unicode digit characters)"""
+    return s.isascii() and s.isdigit()
+
+def _parse_tags(text: str):
+    """Scan text for the [Sxx-Exx] episode tag and the following [NNN]/[NNNP]
+    quality tag (e.g. '[S01-E07] Show [1080P].mkv' -> (7, 1080)).
+
+    The filename convention is rigid enough that a plain find/slice scan is
+    much cheaper than the regex engine; returns (episode, quality) with None
+    for whichever tag is missing or malformed.
+    """
+    text = text.upper()  # tags are case-insensitive ([s01-e07], [720p])
+    i = text.find('[S')
+    while i >= 0:
+        j = text.find('-E', i + 2)
+        if j < 0:
+            break
+        if _ascii_digits(text[i + 2:j]):
+            k = text.find(']', j + 2)
+            if k > j + 2 and _ascii_digits(text[j + 2:k]):
+                episode = int(text[j + 2:k])
+                quality = None
+                # Quality is the next bracketed block after the episode tag
+                b = text.find('[', k + 1)
+                if b >= 0:
+                    e = text.find(']', b + 1)
+                    if e > b + 1:
+                        digits = text[b + 1:e]
+                        if digits.endswith('P'):
+                            digits = digits[:-1]
+                        if _ascii_digits(digits):
+                            quality = int(digits)
+                return episode, quality
+        i = text.find('[S', i + 1)
+    return None, None
+
 class HealthCheckHandler(BaseHTTPRequestHandler):
     """Health check endpoint for Render"""
     
@@ -68,48 +113,181 @@ def run_health_server():
         logger.info(f"Health check server running on port {PORT}")
         server.serve_forever()
     except Exception as e:
-        logger.error(f"Health server error: {e}")
+        logger.error("Health server error: %s", e)
 
 class VideoFile:
+    # Sessions can hold hundreds of these until /endsequence, so avoid the
+    # per-instance __dict__
+    __slots__ = ('file_id', 'filename', 'caption', 'file_type', 'episode_number', 'video_quality')
+
     def __init__(self, file_id: str, filename: str, caption: Optional[str] = None, file_type: str = 'document'):
         self.file_id = file_id
         self.filename = filename
         self.caption = caption or ''
-        self.file_type = file_type
-        self.episode_number = self.extract_episode_number()
-        self.video_quality = self.extract_video_quality()
-
-    def extract_episode_number(self) -> Optional[int]:
-        """Extract episode number from filename or caption (e.g., [S01-E07] -> 7)"""
-        pattern = r'\[S\d+-E(\d+)\]'
+        # Interned so the 'video'/'document' comparisons are pointer checks
+        self.file_type = sys.intern(file_type)
+        self.episode_number: Optional[int] = None
+        self.video_quality: Optional[int] = None
+        self.extract_tags()
+
+    def extract_tags(self):
+        """Extract episode number and quality from filename or caption in one pass
+        (e.g., [S01-E07] ... [1080P] -> episode 7, quality 1080)"""
         for text in [self.filename, self.caption]:
-            match = re.search(pattern, text)
-            if match:
-                return int(match.group(1))
-        return None
-
-    def extract_video_quality(self) -> Optional[int]:
-        """Extract video quality from filename or caption (e.g., [1080] or [1080P] -> 1080)"""
-        pattern = r'\[S\d+-E\d+\].*\[(\d+)(P)?\]'  # Matches [1080] or [1080P]
-        for text in [self.filename, self.caption]:
-            match = re.search(pattern, text)
-            if match:
-                quality = int(match.group(1))
-                common_qualities = [144, 240, 360, 480, 720, 1080, 1440, 2160]
-                return quality if quality in common_qualities else None
-        return None
+            if '[S' not in text and '[s' not in text:
+                # No episode tag possible; skip the upper() copy and scan
+                continue
+            episode, quality = _parse_tags(text)
+            if episode is not None:
+                self.episode_number = episode
+                if quality is not None and quality in _QUALITY_SET:
+                    self.video_quality = quality
+                return
+
+    @classmethod
+    def from_row(cls, file_id, filename, caption, file_type, episode, quality):
+        """Rebuild a VideoFile from a session_files row without re-parsing tags"""
+        video_file = cls.__new__(cls)
+        video_file.file_id = file_id
+        video_file.filename = filename
+        video_file.caption = caption
+        video_file.file_type = sys.intern(file_type)
+        video_file.episode_number = episode
+        video_file.video_quality = quality
+        return video_file
 
     def __str__(self):
         return f"Episode {self.episode_number}, Quality {self.video_quality}: {self.filename}"
 
+# Maps file_type to (bot method name, keyword the file id is passed under)
+_SENDERS = {
+    'video': ('send_video', 'video'),
+    'document': ('send_document', 'document'),
+}
+
+# Message templates built once at import time; per-request values are filled
+# in via .format
+_WELCOME_TEMPLATE = (
+    "{greeting}! 🎬 **Video Sorter Bot** 🎬\n\n"
+    "Current time: {time} on Monday, September 08, 2025. "
+    "Welcome! I help you organize and sequence video files (like TV show episodes) "
+    "based on their episode number and quality.\n\n"
+    "**How it works:**\n"
+    "1. Use `/sequence` to start sending me your video files\n"
+    "2. Send me your video files one by one\n"
+    "3. Use `/endsequence` when you're done\n"
+    "4. I'll sort them by quality (480p, 720p, 1080p) and episode number, "
+    "sending each quality block separately!\n"
+    "5. Use `/dump <channel>` to set a private or public dump channel for sorted files "
+    "(add the bot to the channel first).\n\n"
+    "**File format expected:** `[S01-E07] Show Name [1080P] [Single].mkv`\n\n"
+    "Ready to get started? Use `/sequence` to begin!"
+)
+
+_SEQUENCE_MESSAGE = (
+    "📁 **Ready to receive files!** 📁\n\n"
+    "Please start sending me your video files. I'll collect them and sort them "
+    "when you use `/endsequence`.\n\n"
+    "**Tip:** Make sure your files follow the naming convention:\n"
+    "`[S01-E07] Show Name [1080P] [Single].extension`"
+)
+
+_DUMP_OK_TEMPLATE = (
+    "✅ Dump channel set to `{channel}`. Sorted files will be sent here too! "
+    "Ensure the bot is added to the channel with send permissions."
+)
+
 class VideoSorterBot:
     def __init__(self):
-        self.user_sessions: Dict[int, List[VideoFile]] = {}
+        # Maps user_id -> pending file count; the file metadata itself lives
+        # in SQLite (session_files), so only this small marker stays in RAM.
+        # Abandoned sessions expire after an hour; their rows are cleared the
+        # next time the user runs /sequence.
+        self.user_sessions: TTLCache = TTLCache(maxsize=10000, ttl=3600)
+        self.db: Optional[aiosqlite.Connection] = None
+        self.session_sweeper_task: Optional[asyncio.Task] = None
         self.dump_channels: Dict[int, str] = {}  # Store dump channel ID or username per user
         self.log_channel_id = LOG_CHANNEL_ID
+        # Bound concurrent sends below Telegram's ~30 msg/s global limit
+        self.send_semaphore = asyncio.Semaphore(20)
+        # Log entries are queued here and batched by _log_flusher
+        self.log_queue: asyncio.Queue = asyncio.Queue()
+        self.log_flusher_task: Optional[asyncio.Task] = None
+        # One queue + worker task per user so a big /endsequence job never
+        # blocks other users' commands
+        self.user_queues: Dict[int, asyncio.Queue] = {}
+
+    async def _get_db(self) -> aiosqlite.Connection:
+        """Open the SQLite store for pending session files (once, lazily, so
+        the connection is bound to the application's event loop)"""
+        if self.db is None:
+            self.db = await aiosqlite.connect(SESSION_DB_PATH)
+            await self.db.execute(
+                "CREATE TABLE IF NOT EXISTS session_files ("
+                "  user_id INTEGER NOT NULL,"
+                "  seq INTEGER NOT NULL,"
+                "  file_id TEXT NOT NULL,"
+                "  filename TEXT NOT NULL,"
+                "  caption TEXT NOT NULL,"
+                "  file_type TEXT NOT NULL,"
+                "  episode INTEGER,"
+                "  quality INTEGER,"
+                "  PRIMARY KEY (user_id, seq)"
+                ")"
+            )
+            await self.db.commit()
+            if self.session_sweeper_task is None:
+                self.session_sweeper_task = asyncio.create_task(self._sweep_orphaned_files())
+        return self.db
+
+    async def _sweep_orphaned_files(self):
+        """Background task: delete session_files rows for users whose TTL
+        marker has expired (uploaded files but never sent /endsequence), so
+        the session cap of user_sessions also bounds the on-disk store"""
+        while True:
+            try:
+                await asyncio.sleep(600)
+                db = await self._get_db()
+                active = list(self.user_sessions.keys())
+                if active:
+                    placeholders = ",".join("?" * len(active))
+                    cursor = await db.execute(
+                        f"DELETE FROM session_files WHERE user_id NOT IN ({placeholders})",
+                        active
+                    )
+                else:
+                    cursor = await db.execute("DELETE FROM session_files")
+                await db.commit()
+                if cursor.rowcount:
+                    logger.info("Swept %s orphaned session file rows", cursor.rowcount)
+            except Exception as e:
+                logger.error("Error sweeping orphaned session files: %s", e)
+
+    async def _store_file(self, user_id: int, seq: int, video_file: VideoFile):
+        """Persist one received file to the session store"""
+        db = await self._get_db()
+        await db.execute(
+            "INSERT OR REPLACE INTO session_files"
+            " (user_id, seq, file_id, filename, caption, file_type, episode, quality)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, seq, video_file.file_id, video_file.filename,
+             video_file.caption, video_file.file_type,
+             video_file.episode_number, video_file.video_quality)
+        )
+        await db.commit()
+
+    async def post_shutdown(self, application: Application):
+        """Close the session store on application shutdown; aiosqlite's worker
+        thread is non-daemon and would otherwise block interpreter exit"""
+        if self.session_sweeper_task is not None:
+            self.session_sweeper_task.cancel()
+            self.session_sweeper_task = None
+        if self.db is not None:
+            await self.db.close()
+            self.db = None
 
     async def log_action(self, context: ContextTypes.DEFAULT_TYPE, user_id: int, username: str, action: str, details: str = ""):
-        """Log user actions to the designated log channel with error handling"""
+        """Queue a user action for the log channel; entries are batched by _log_flusher"""
         if self.log_channel_id:
             timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S IST")
             log_message = (
@@ -118,59 +296,58 @@ class VideoSorterBot:
                 f"📋 Action: {action}\n"
                 f"📝 Details: {details}"
             )
+            self.log_queue.put_nowait(log_message)
+            if self.log_flusher_task is None:
+                self.log_flusher_task = asyncio.create_task(self._log_flusher(context.bot))
+            logger.debug("Queued log action for user %s: %s", user_id, action)
+
+    async def _log_flusher(self, bot):
+        """Background task: drain queued log entries every few seconds and send
+        them as one message (split at Telegram's ~4096-char limit) instead of
+        one API call per event"""
+        while True:
             try:
-                await context.bot.send_message(chat_id=self.log_channel_id, text=log_message)
-                logger.debug(f"Logged action for user {user_id}: {action}")
+                await asyncio.sleep(3)
+                if self.log_queue.empty():
+                    continue
+                entries = []
+                while not self.log_queue.empty():
+                    entries.append(self.log_queue.get_nowait())
+                batch = "\n\n".join(entries)
+                for start in range(0, len(batch), 4000):
+                    await bot.send_message(chat_id=self.log_channel_id, text=batch[start:start + 4000])
             except TelegramError as e:
-                logger.error(f"Failed to log action to channel {self.log_channel_id}: {e}")
+                logger.error("Failed to send batched log to channel %s: %s", self.log_channel_id, e)
             except Exception as e:
-                logger.error(f"Unexpected error logging action: {e}")
+                logger.error("Unexpected error in log flusher: %s", e)
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
         try:
-            current_time = datetime.now().strftime("%I:%M %p IST")
-            greeting = "Good evening" if datetime.now().hour >= 17 else "Hello"
-            welcome_message = (
-                f"{greeting}! 🎬 **Video Sorter Bot** 🎬\n\n"
-                f"Current time: {current_time} on Monday, September 08, 2025. "
-                "Welcome! I help you organize and sequence video files (like TV show episodes) "
-                "based on their episode number and quality.\n\n"
-                "**How it works:**\n"
-                "1. Use `/sequence` to start sending me your video files\n"
-                "2. Send me your video files one by one\n"
-                "3. Use `/endsequence` when you're done\n"
-                "4. I'll sort them by quality (480p, 720p, 1080p) and episode number, "
-                "sending each quality block separately!\n"
-                "5. Use `/dump <channel>` to set a private or public dump channel for sorted files "
-                "(add the bot to the channel first).\n\n"
-                "**File format expected:** `[S01-E07] Show Name [1080P] [Single].mkv`\n\n"
-                "Ready to get started? Use `/sequence` to begin!"
-            )
+            now = datetime.now()
+            current_time = now.strftime("%I:%M %p IST")
+            greeting = "Good evening" if now.hour >= 17 else "Hello"
+            welcome_message = _WELCOME_TEMPLATE.format(greeting=greeting, time=current_time)
             await update.message.reply_text(welcome_message, parse_mode='Markdown')
             username = update.effective_user.username or "Unknown"
             await self.log_action(context, update.effective_user.id, username, "Started the bot")
         except Exception as e:
-            logger.error(f"Error in start_command: {e}")
+            logger.error("Error in start_command: %s", e)
             await update.message.reply_text("Error occurred. Please try again.")
 
     async def sequence_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /sequence command"""
         try:
             user_id = update.effective_user.id
-            self.user_sessions[user_id] = []
-            message = (
-                "📁 **Ready to receive files!** 📁\n\n"
-                "Please start sending me your video files. I'll collect them and sort them "
-                "when you use `/endsequence`.\n\n"
-                "**Tip:** Make sure your files follow the naming convention:\n"
-                "`[S01-E07] Show Name [1080P] [Single].extension`"
-            )
-            await update.message.reply_text(message, parse_mode='Markdown')
+            db = await self._get_db()
+            await db.execute("DELETE FROM session_files WHERE user_id = ?", (user_id,))
+            await db.commit()
+            self.user_sessions[user_id] = 0
+            await update.message.reply_text(_SEQUENCE_MESSAGE, parse_mode='Markdown')
             username = update.effective_user.username or "Unknown"
             await self.log_action(context, user_id, username, "Started sequence collection")
         except Exception as e:
-            logger.error(f"Error in sequence_command: {e}")
+            logger.error("Error in sequence_command: %s", e)
             await update.message.reply_text("Error occurred. Please try again.")
 
     async def dump_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -185,78 +362,90 @@ class VideoSorterBot:
             channel = context.args[0]
             self.dump_channels[user_id] = channel
             await update.message.reply_text(
-                f"✅ Dump channel set to `{channel}`. Sorted files will be sent here too! "
-                "Ensure the bot is added to the channel with send permissions.",
+                _DUMP_OK_TEMPLATE.format(channel=channel),
                 parse_mode='Markdown'
             )
             username = update.effective_user.username or "Unknown"
             await self.log_action(context, user_id, username, "Set dump channel", f"Channel: {channel}")
         except Exception as e:
-            logger.error(f"Error in dump_command: {e}")
+            logger.error("Error in dump_command: %s", e)
             await update.message.reply_text("Error occurred. Please try again.")
 
-    async def send_files_with_retry(self, context: ContextTypes.DEFAULT_TYPE, chat_id, video_file, dump_chat_id=None):
-        """Send files with retry logic and rate limiting"""
+    async def _send_one(self, context: ContextTypes.DEFAULT_TYPE, chat_id, video_file):
+        """Send a single file to one chat with retry logic, bounded by the send semaphore"""
         max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                if video_file.file_type == 'video':
-                    await context.bot.send_video(
-                        chat_id=chat_id,
-                        video=video_file.file_id,
-                        caption=video_file.caption
-                    )
-                    if dump_chat_id:
-                        await asyncio.sleep(1)  # Rate limiting
-                        await context.bot.send_video(
-                            chat_id=dump_chat_id,
-                            video=video_file.file_id,
-                            caption=video_file.caption
-                        )
-                else:
-                    await context.bot.send_document(
-                        chat_id=chat_id,
-                        document=video_file.file_id,
-                        caption=video_file.caption
-                    )
-                    if dump_chat_id:
-                        await asyncio.sleep(1)  # Rate limiting
-                        await context.bot.send_document(
-                            chat_id=dump_chat_id,
-                            document=video_file.file_id,
-                            caption=video_file.caption
-                        )
-                return True
-            except TelegramError as e:
-                if "Too Many Requests" in str(e):
-                    wait_time = 2 ** attempt
-                    logger.warning(f"Rate limited, waiting {wait_time} seconds")
-                    await asyncio.sleep(wait_time)
-                elif attempt == max_retries - 1:
-                    logger.error(f"Failed to send file after {max_retries} attempts: {e}")
-                    return False
-                else:
-                    await asyncio.sleep(1)
-            except Exception as e:
-                logger.error(f"Unexpected error sending file: {e}")
-                if attempt == max_retries - 1:
-                    return False
-                await asyncio.sleep(1)
+        method_name, file_kwarg = _SENDERS.get(video_file.file_type, _SENDERS['document'])
+        send = getattr(context.bot, method_name)
+        kwargs = {'chat_id': chat_id, 'caption': video_file.caption, file_kwarg: video_file.file_id}
+        async with self.send_semaphore:
+            for attempt in range(max_retries):
+                try:
+                    await send(**kwargs)
+                    return True
+                except RetryAfter as e:
+                    # Back off exactly as long as Telegram asks, then retry
+                    logger.warning("Rate limited, waiting %s seconds", e.retry_after)
+                    await asyncio.sleep(e.retry_after)
+                except TimedOut:
+                    # The request already waited out its timeout; retry immediately
+                    if attempt == max_retries - 1:
+                        logger.error("Send timed out after %s attempts", max_retries)
+                        return False
+                except TelegramError as e:
+                    if attempt == max_retries - 1:
+                        logger.error("Failed to send file after %s attempts: %s", max_retries, e)
+                        return False
+                except Exception as e:
+                    logger.error("Unexpected error sending file: %s", e)
+                    if attempt == max_retries - 1:
+                        return False
         return False
 
+    async def send_files_concurrently(self, context: ContextTypes.DEFAULT_TYPE, chat_id, video_files, dump_chat_id=None):
+        """Dispatch user and dump-channel sends for a block of files concurrently.
+
+        The semaphore in _send_one provides the rate limiting, so no fixed
+        sleeps are needed between sends. Returns the files that failed.
+        """
+        jobs = []
+        for video_file in video_files:
+            jobs.append((video_file, self._send_one(context, chat_id, video_file)))
+            if dump_chat_id:
+                jobs.append((video_file, self._send_one(context, dump_chat_id, video_file)))
+        results = await asyncio.gather(*(coro for _, coro in jobs), return_exceptions=True)
+        failed = []
+        for (video_file, _), result in zip(jobs, results):
+            if result is not True and video_file not in failed:
+                failed.append(video_file)
+        return failed
+
     async def endsequence_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /endsequence command with improved error handling"""
+        """Handle /endsequence command: hand the session to this user's worker
+        so long send jobs don't block other users' commands"""
         try:
             user_id = update.effective_user.id
-            if user_id not in self.user_sessions or not self.user_sessions[user_id]:
+            if not self.user_sessions.get(user_id):
                 await update.message.reply_text(
                     "❌ No files received yet! Use `/sequence` first and send some video files."
                 )
                 return
 
-            files = self.user_sessions[user_id]
+            # Episode-ordered straight from the B-tree; Python never sorts these
+            db = await self._get_db()
+            cursor = await db.execute(
+                "SELECT file_id, filename, caption, file_type, episode, quality"
+                " FROM session_files WHERE user_id = ? ORDER BY episode, quality, seq",
+                (user_id,)
+            )
+            rows = await cursor.fetchall()
+            await cursor.close()
+            await db.execute("DELETE FROM session_files WHERE user_id = ?", (user_id,))
+            await db.commit()
+            self.user_sessions.pop(user_id, None)
+
+            files = [VideoFile.from_row(*row) for row in rows]
             file_count = len(files)
-            
+
             await update.message.reply_text(
                 f"📊 Sequence added to queue. Received {file_count} files."
             )
@@ -264,96 +453,105 @@ class VideoSorterBot:
             username = update.effective_user.username or "Unknown"
             await self.log_action(context, user_id, username, "Ended sequence", f"Files received: {file_count}")
 
-            # Filter valid files
-            valid_files = [f for f in files if f.episode_number is not None and f.video_quality is not None]
-            invalid_files = [f for f in files if f.episode_number is None or f.video_quality is None]
+            queue = self.user_queues.get(user_id)
+            if queue is None:
+                queue = self.user_queues[user_id] = asyncio.Queue()
+                asyncio.create_task(self._drain_user_queue(user_id))
+            queue.put_nowait((update, context, files))
 
-            if not valid_files:
-                await update.message.reply_text(
-                    "❌ No valid files could be processed. Please check the file naming convention."
-                )
-                del self.user_sessions[user_id]
-                return
+        except Exception as e:
+            logger.error("Error in endsequence_command: %s", e)
+            await update.message.reply_text("❌ Error processing files. Please try again.")
 
-            # Group and sort files by quality
-            quality_groups = {480: [], 720: [], 1080: []}
-            other_files = []
-            
-            for f in valid_files:
-                if f.video_quality in quality_groups:
-                    quality_groups[f.video_quality].append(f)
-                else:
-                    other_files.append(f)
-
-            for quality in quality_groups:
-                quality_groups[quality].sort(key=lambda x: x.episode_number)
-            
-            other_files.sort(key=lambda x: (x.episode_number, x.video_quality or 0))
-
-            # Send sorted files by quality blocks
-            await update.message.reply_text("🔄 Sending sorted files by quality...")
-            dump_chat_id = self.dump_channels.get(user_id)
-
-            for quality in [480, 720, 1080]:
-                if quality_groups[quality]:
-                    await update.message.reply_text(
-                        f"📺 **{quality}P QUALITY EPISODES** 📺\n"
-                        f"Sending {len(quality_groups[quality])} episodes in {quality}p quality...",
-                        parse_mode='Markdown'
-                    )
-                    
-                    for video_file in quality_groups[quality]:
-                        success = await self.send_files_with_retry(
-                            context, update.effective_chat.id, video_file, dump_chat_id
-                        )
-                        if not success:
-                            await update.message.reply_text(
-                                f"❌ Error sending file: {video_file.caption or video_file.filename}"
-                            )
-
-            if other_files:
+    async def _drain_user_queue(self, user_id: int):
+        """Worker task: process queued /endsequence jobs for one user in order"""
+        queue = self.user_queues[user_id]
+        while True:
+            update, context, files = await queue.get()
+            try:
+                await self._process_sequence(update, context, files)
+            except Exception as e:
+                logger.error("Error processing sequence for user %s: %s", user_id, e)
+                try:
+                    await update.message.reply_text("❌ Error processing files. Please try again.")
+                except Exception:
+                    pass
+            finally:
+                queue.task_done()
+
+    async def _process_sequence(self, update: Update, context: ContextTypes.DEFAULT_TYPE, files: List[VideoFile]):
+        """Sort and send one collected sequence (runs on the user's worker task).
+
+        files arrives episode-ordered from the session store query, so a
+        single pass of appends leaves every bucket already in send order."""
+        user_id = update.effective_user.id
+        file_count = len(files)
+
+        quality_groups = {480: [], 720: [], 1080: []}
+        other_files = []
+        valid_count = 0
+
+        for f in files:
+            if f.episode_number is None or f.video_quality is None:
+                continue
+            valid_count += 1
+            bucket = quality_groups.get(f.video_quality)
+            if bucket is not None:
+                bucket.append(f)
+            else:
+                other_files.append(f)
+
+        if not valid_count:
+            await update.message.reply_text(
+                "❌ No valid files could be processed. Please check the file naming convention."
+            )
+            return
+
+        # Send sorted files by quality blocks
+        await update.message.reply_text("🔄 Sending sorted files by quality...")
+        dump_chat_id = self.dump_channels.get(user_id)
+
+        for quality in [480, 720, 1080, None]:
+            ordered = quality_groups[quality] if quality else other_files
+            if not ordered:
+                continue
+            if quality:
+                label, detail = f"{quality}P QUALITY", f"in {quality}p quality"
+            else:
+                label, detail = "OTHER QUALITY", "with unknown quality"
+            await update.message.reply_text(
+                f"📺 **{label} EPISODES** 📺\n"
+                f"Sending {len(ordered)} episodes {detail}...",
+                parse_mode='Markdown'
+            )
+
+            failed = await self.send_files_concurrently(
+                context, update.effective_chat.id, ordered, dump_chat_id
+            )
+            for video_file in failed:
                 await update.message.reply_text(
-                    f"📺 **OTHER QUALITY EPISODES** 📺\n"
-                    f"Sending {len(other_files)} episodes with unknown quality...",
-                    parse_mode='Markdown'
+                    f"❌ Error sending file: {video_file.caption or video_file.filename}"
                 )
-                
-                for video_file in other_files:
-                    success = await self.send_files_with_retry(
-                        context, update.effective_chat.id, video_file, dump_chat_id
-                    )
-                    if not success:
-                        await update.message.reply_text(
-                            f"❌ Error sending file: {video_file.caption or video_file.filename}"
-                        )
 
-            # Generate and send summary
-            summary = await self.generate_summary(valid_files, file_count, quality_groups, other_files)
-            await update.message.reply_text(summary, parse_mode='Markdown')
+        # Generate and send summary
+        summary = await self.generate_summary(valid_count, file_count, quality_groups, other_files)
+        await update.message.reply_text(summary, parse_mode='Markdown')
 
-            # Clear the session
-            del self.user_sessions[user_id]
-
-        except Exception as e:
-            logger.error(f"Error in endsequence_command: {e}")
-            await update.message.reply_text("❌ Error processing files. Please try again.")
-
-    async def generate_summary(self, valid_files: List[VideoFile], total_files: int, quality_groups: Dict, other_files: List[VideoFile]) -> str:
+    async def generate_summary(self, processed_count: int, total_files: int, quality_groups: Dict, other_files: List[VideoFile]) -> str:
         """Generate summary message with missing episodes info"""
-        processed_count = len(valid_files)
         summary = "✅ **SORTING COMPLETE** ✅\n"
         summary += f"📊 {processed_count}/{total_files} files sorted by quality\n\n"
         
         # Quality block summary
         for quality in [480, 720, 1080]:
             if quality_groups[quality]:
-                episodes = sorted([f.episode_number for f in quality_groups[quality]])
-                episode_range = f"E{episodes[0]:02d}-E{episodes[-1]:02d}" if episodes else "None"
+                episodes = [f.episode_number for f in quality_groups[quality]]
+                episode_range = f"E{min(episodes):02d}-E{max(episodes):02d}"
                 summary += f"📺 {quality}p: {len(quality_groups[quality])} episodes ({episode_range})\n"
-        
+
         if other_files:
-            episodes = sorted([f.episode_number for f in other_files if f.episode_number])
-            episode_range = f"E{episodes[0]:02d}-E{episodes[-1]:02d}" if episodes else "None"
+            episodes = [f.episode_number for f in other_files if f.episode_number]
+            episode_range = f"E{min(episodes):02d}-E{max(episodes):02d}" if episodes else "None"
             summary += f"📺 Other: {len(other_files)} episodes ({episode_range})\n"
         
         failed_count = total_files - processed_count
@@ -378,7 +576,9 @@ class VideoSorterBot:
                 filename = document.file_name or "unknown_file"
                 caption = update.message.caption or ''
                 video_file = VideoFile(document.file_id, filename, caption, 'document')
-                self.user_sessions[user_id].append(video_file)
+                seq = self.user_sessions.get(user_id, 0)
+                await self._store_file(user_id, seq, video_file)
+                self.user_sessions[user_id] = seq + 1
                 
                 if video_file.episode_number is not None and video_file.video_quality is not None:
                     status = f"✅ Episode {video_file.episode_number}, Quality {video_file.video_quality}p"
@@ -393,7 +593,7 @@ class VideoSorterBot:
                 username = update.effective_user.username or "Unknown"
                 await self.log_action(context, user_id, username, "Uploaded document", f"File: {filename}")
         except Exception as e:
-            logger.error(f"Error in handle_document: {e}")
+            logger.error("Error in handle_document: %s", e)
             await update.message.reply_text("Error processing document. Please try again.")
 
     async def handle_video(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -411,7 +611,9 @@ class VideoSorterBot:
                 filename = video.file_name or f"video_{video.file_id[:8]}.mp4"
                 caption = update.message.caption or ''
                 video_file = VideoFile(video.file_id, filename, caption, 'video')
-                self.user_sessions[user_id].append(video_file)
+                seq = self.user_sessions.get(user_id, 0)
+                await self._store_file(user_id, seq, video_file)
+                self.user_sessions[user_id] = seq + 1
                 
                 if video_file.episode_number is not None and video_file.video_quality is not None:
                     status = f"✅ Episode {video_file.episode_number}, Quality {video_file.video_quality}p"
@@ -426,7 +628,7 @@ class VideoSorterBot:
                 username = update.effective_user.username or "Unknown"
                 await self.log_action(context, user_id, username, "Uploaded video", f"File: {filename}")
         except Exception as e:
-            logger.error(f"Error in handle_video: {e}")
+            logger.error("Error in handle_video: %s", e)
             await update.message.reply_text("Error processing video. Please try again.")
 
 async def setup_bot():
@@ -440,13 +642,24 @@ async def setup_bot():
             BotCommand("dump", "Set a dump channel (e.g., /dump @Channel)"),
         ]
 
-        application = Application.builder().token(BOT_TOKEN).build()
-        
+        bot = VideoSorterBot()
+
+        # Larger pool + HTTP/2 multiplexing so the concurrent send path isn't
+        # throttled by the default 10-connection pool
+        request = HTTPXRequest(connection_pool_size=64, pool_timeout=30.0, http_version="2")
+        get_updates_request = HTTPXRequest(http_version="2")
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .request(request)
+            .get_updates_request(get_updates_request)
+            .post_shutdown(bot.post_shutdown)
+            .build()
+        )
+
         # Set commands menu
         await application.bot.set_my_commands(commands)
-        
-        bot = VideoSorterBot()
-        
+
         # Add command handlers
         application.add_handler(CommandHandler("start", bot.start_command))
         application.add_handler(CommandHandler("sequence", bot.sequence_command))
@@ -459,14 +672,22 @@ async def setup_bot():
 
         return application
     except Exception as e:
-        logger.error(f"Error setting up bot: {e}")
+        logger.error("Error setting up bot: %s", e)
         raise
 
 def main():
     """Main function optimized for Render deployment"""
     logger.info("🚀 Starting Video Sorter Bot on Render...")
     logger.info(f"Environment: PORT={PORT}, WEBHOOK_URL={'Set' if WEBHOOK_URL else 'Not set'}")
-    
+
+    # Use uvloop when available for a faster event loop on this I/O-bound workload
+    try:
+        import uvloop
+        uvloop.install()
+        logger.info("Using uvloop event loop")
+    except ImportError:
+        logger.info("uvloop not available, using default asyncio event loop")
+
     try:
         # Start health check server in background thread
         health_thread = threading.Thread(target=run_health_server, daemon=True)
@@ -498,7 +719,7 @@ def main():
     except KeyboardInterrupt:
         logger.info("🛑 Bot stopped by user")
     except Exception as e:
-        logger.error(f"Critical bot error: {e}")
+        logger.error("Critical bot error: %s", e)
         raise
 
 if __name__ == '__main__':